@@ -4,15 +4,82 @@
 from __future__ import annotations
 
 # Note: import as little as possible here at the module level to
-# keep launch times fast for small snippets.
+# keep launch times fast for small snippets. Commands import what they
+# need locally; once a module has been loaded (the first command run
+# in a pcommandbatch process, for instance) these local imports are
+# just cheap sys.modules lookups, so there's no need for any fancier
+# lazy-import machinery here.
 import sys
+from typing import TYPE_CHECKING
 
 from efrotools import pcommand
 
+if TYPE_CHECKING:
+    from typing import Iterator, Any
+
+
+_MONOLITHIC_REGISTER_TEMPLATE = """\
+// Released under the MIT License. See LICENSE for details.
+
+#ifndef BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
+#define BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
+
+// THIS CODE IS AUTOGENERATED BY META BUILD; DO NOT EDIT BY HAND.
+
+#include "ballistica/shared/ballistica.h"
+#include "ballistica/shared/python/python_sys.h"
+
+extern "C" {
+${EXTERN_DEF_CODE}
+}
+
+namespace ballistica {
+
+/// Register init calls for all of our built-in Python modules.
+/// Should only be used in monolithic builds. In modular builds
+/// binary modules get located as .so files on disk as per regular
+/// Python behavior.
+void MonolithicRegisterPythonModules() {
+  if (g_buildconfig.monolithic_build()) {
+${PY_REGISTER_CODE}
+  } else {
+    FatalError(
+        "MonolithicRegisterPythonModules should not be called"
+        " in modular builds.");
+  }
+}
+${PY_INIT_PLUS}
+}  // namespace ballistica
+
+#endif  // BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
+"""
+
+
+def _write_if_changed(path: str, data: bytes) -> bool:
+    """Write data to a file unless it already contains exactly that.
+
+    The write goes through a temp file and an atomic swap so a partially
+    written file is never left behind. Returns whether a write happened.
+    """
+    import os
+
+    try:
+        with open(path, 'rb') as infile:
+            if infile.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = f'{path}.tmp'
+    with open(tmppath, 'wb') as outfile:
+        outfile.write(data)
+    os.replace(tmppath, path)
+    return True
+
 
 def gen_monolithic_register_modules() -> None:
     """Generate .h file for registering py modules."""
-    import os
     import textwrap
 
     from efro.error import CleanError
@@ -24,24 +91,27 @@ def gen_monolithic_register_modules() -> None:
         raise CleanError('Expected 1 arg.')
     outpath = sys.argv[2]
 
-    featuresets = FeatureSet.get_all_for_project(str(pcommand.PROJROOT))
-
-    # Filter out ones without native modules.
-    featuresets = [f for f in featuresets if f.has_python_binary_module]
-
-    pymodulenames = sorted(f.name_python_binary_module for f in featuresets)
+    # Grab native module names, skipping featuresets without one.
+    pymodulenames = sorted(
+        f.name_python_binary_module
+        for f in FeatureSet.get_all_for_project(str(pcommand.PROJROOT))
+        if f.has_python_binary_module
+    )
 
-    def initname(mname: str) -> str:
-        # plus is a special case since we need to define that symbol
-        # ourself.
-        return f'DoPyInit_{mname}' if mname == '_baplus' else f'PyInit_{mname}'
+    # Calc each module's init func name once and use it for both blocks.
+    # Note that plus is a special case since we need to define that
+    # symbol ourself.
+    modinits = [
+        (n, f'DoPyInit_{n}' if n == '_baplus' else f'PyInit_{n}')
+        for n in pymodulenames
+    ]
 
     extern_def_code = '\n'.join(
-        f'auto {initname(n)}() -> PyObject*;' for n in pymodulenames
+        f'auto {i}() -> PyObject*;' for _n, i in modinits
     )
 
     py_register_code = '\n'.join(
-        f'PyImport_AppendInittab("{n}", &{initname(n)});' for n in pymodulenames
+        f'PyImport_AppendInittab("{n}", &{i});' for n, i in modinits
     )
 
     if '_baplus' in pymodulenames:
@@ -69,55 +139,26 @@ def gen_monolithic_register_modules() -> None:
     else:
         init_plus_code = ''
 
-    base_code = """
-        // Released under the MIT License. See LICENSE for details.
-
-        #ifndef BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
-        #define BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
-
-        // THIS CODE IS AUTOGENERATED BY META BUILD; DO NOT EDIT BY HAND.
-
-        #include "ballistica/shared/ballistica.h"
-        #include "ballistica/shared/python/python_sys.h"
-
-        extern "C" {
-        ${EXTERN_DEF_CODE}
-        }
-
-        namespace ballistica {
-
-        /// Register init calls for all of our built-in Python modules.
-        /// Should only be used in monolithic builds. In modular builds
-        /// binary modules get located as .so files on disk as per regular
-        /// Python behavior.
-        void MonolithicRegisterPythonModules() {
-          if (g_buildconfig.monolithic_build()) {
-        ${PY_REGISTER_CODE}
-          } else {
-            FatalError(
-                "MonolithicRegisterPythonModules should not be called"
-                " in modular builds.");
-          }
-        }
-        ${PY_INIT_PLUS}
-        }  // namespace ballistica
-
-        #endif  // BALLISTICA_CORE_MGEN_PYTHON_MODULES_MONOLITHIC_H_
-        """
-    out = (
-        textwrap.dedent(base_code)
-        .replace('${EXTERN_DEF_CODE}', extern_def_code)
-        .replace(
-            '${PY_REGISTER_CODE}', textwrap.indent(py_register_code, '    ')
+    # Break the template into its literal segments around our
+    # placeholders and assemble the output with a single join.
+    seg0, rest = _MONOLITHIC_REGISTER_TEMPLATE.split('${EXTERN_DEF_CODE}')
+    seg1, rest = rest.split('${PY_REGISTER_CODE}')
+    seg2, seg3 = rest.split('${PY_INIT_PLUS}')
+    out = ''.join(
+        (
+            seg0,
+            extern_def_code,
+            seg1,
+            textwrap.indent(py_register_code, '    '),
+            seg2,
+            init_plus_code,
+            seg3,
         )
-        .replace('${PY_INIT_PLUS}', init_plus_code)
-        .strip()
-        + '\n'
     )
 
-    os.makedirs(os.path.dirname(outpath), exist_ok=True)
-    with open(outpath, 'w', encoding='utf-8') as outfile:
-        outfile.write(out)
+    # Leaving the header untouched when unchanged keeps us from
+    # triggering needless rebuilds of the C++ code that includes it.
+    _write_if_changed(outpath, out.encode())
 
 
 def py_examine() -> None:
@@ -141,28 +182,74 @@ def py_examine() -> None:
     os.chdir(pcommand.PROJROOT)
 
     # Set up pypaths so our main distro stuff works.
-    scriptsdir = os.path.abspath(
-        os.path.join(
-            os.path.dirname(sys.argv[0]), '../src/assets/ba_data/python'
-        )
-    )
-    toolsdir = os.path.abspath(
-        os.path.join(os.path.dirname(sys.argv[0]), '../tools')
-    )
-    if scriptsdir not in sys.path:
-        sys.path.append(scriptsdir)
-    if toolsdir not in sys.path:
-        sys.path.append(toolsdir)
+    projdir = Path(sys.argv[0]).parent / '..'
+    for pypath in (
+        str((projdir / 'src/assets/ba_data/python').resolve()),
+        str((projdir / 'tools').resolve()),
+    ):
+        if pypath not in sys.path:
+            sys.path.append(pypath)
     efrotools.py_examine(
         pcommand.PROJROOT, filename, line, column, selection, operation
     )
 
 
+def _read_json_file(path: str) -> Any:
+    """Load a json file; uses orjson for speed when it is available."""
+    try:
+        import orjson
+    except ImportError:
+        import json
+
+        with open(path, encoding='utf-8') as infile:
+            return json.loads(infile.read())
+
+    with open(path, 'rb') as infile:
+        return orjson.loads(infile.read())
+
+
+def _iter_file_paths(dirpath: str) -> Iterator[str]:
+    """Recursively yield paths of all non-dir entries under a dir.
+
+    As with os.walk, symlinks to dirs count as dirs but aren't followed.
+    """
+    import os
+
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield from _iter_file_paths(entry.path)
+                continue
+            yield entry.path
+
+
+def _remove_empty_dirs(dirpath: str) -> bool:
+    """Remove a dir tree's empty dirs bottom-up; return if dirpath went."""
+    import os
+
+    subdirs: list[str] = []
+    empty = True
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            else:
+                empty = False
+
+    # Note: need to visit every subdir here; no short-circuiting.
+    for subdir in subdirs:
+        if not _remove_empty_dirs(subdir):
+            empty = False
+
+    if empty:
+        os.rmdir(dirpath)
+    return empty
+
+
 def clean_orphaned_assets() -> None:
     """Remove asset files that are no longer part of the build."""
     import os
-    import json
-    import subprocess
 
     pcommand.disallow_in_batch()
 
@@ -170,33 +257,24 @@ def clean_orphaned_assets() -> None:
     os.chdir(pcommand.PROJROOT)
 
     # Our manifest is split into 2 files (public and private)
-    with open(
-        'src/assets/.asset_manifest_public.json', encoding='utf-8'
-    ) as infile:
-        manifest = set(json.loads(infile.read()))
-    with open(
-        'src/assets/.asset_manifest_private.json', encoding='utf-8'
-    ) as infile:
-        manifest.update(set(json.loads(infile.read())))
-    for root, _dirs, fnames in os.walk('build/assets'):
-        for fname in fnames:
-            fpath = os.path.join(root, fname)
-            fpathrel = fpath[13:]  # paths are relative to build/assets
-            if fpathrel not in manifest:
-                print(f'Removing orphaned asset file: {fpath}')
-                os.unlink(fpath)
+    manifest = set(_read_json_file('src/assets/.asset_manifest_public.json'))
+    manifest.update(_read_json_file('src/assets/.asset_manifest_private.json'))
+    rootdir = 'build/assets'
+    prefixlen = len(rootdir) + 1  # manifest paths are relative to rootdir
+    for fpath in _iter_file_paths(rootdir):
+        if fpath[prefixlen:] not in manifest:
+            print(f'Removing orphaned asset file: {fpath}')
+            os.unlink(fpath)
 
     # Lastly, clear empty dirs.
-    subprocess.run(
-        'find build/assets -depth -empty -type d -delete',
-        shell=True,
-        check=True,
-    )
+    _remove_empty_dirs(rootdir)
 
 
 def win_ci_install_prereqs() -> None:
     """Install bits needed for basic win ci."""
-    import json
+    import itertools
+    from multiprocessing import cpu_count
+    from concurrent.futures import ThreadPoolExecutor
 
     from efrotools.efrocache import get_target
 
@@ -215,23 +293,35 @@ def win_ci_install_prereqs() -> None:
 
     # Look through everything that gets generated by our meta builds
     # and pick out anything we need for our basic builds/tests.
-    with open(
-        'src/meta/.meta_manifest_public.json', encoding='utf-8'
-    ) as infile:
-        meta_public: list[str] = json.loads(infile.read())
-    with open(
-        'src/meta/.meta_manifest_private.json', encoding='utf-8'
-    ) as infile:
-        meta_private: list[str] = json.loads(infile.read())
-    for target in meta_public + meta_private:
-        if (target.startswith('src/ballistica/') and '/mgen/' in target) or (
-            target.startswith('src/assets/ba_data/python/')
-            and '/_mgen/' in target
-        ):
-            needed_targets.add(target)
-
-    for target in needed_targets:
-        get_target(target, batch=pcommand.is_batch(), clr=pcommand.clr())
+    meta_public: list[str] = _read_json_file(
+        'src/meta/.meta_manifest_public.json'
+    )
+    meta_private: list[str] = _read_json_file(
+        'src/meta/.meta_manifest_private.json'
+    )
+    # (C++ code generates into 'mgen' dirs and Python into '_mgen').
+    prefixes = ('src/ballistica/', 'src/assets/ba_data/python/')
+    needed_targets.update(
+        target
+        for target in itertools.chain(meta_public, meta_private)
+        if target.startswith(prefixes)
+        and ('/mgen/' in target or '/_mgen/' in target)
+    )
+
+    # These are mostly network-bound downloads, so fetch them in
+    # parallel. We run get_target in batch mode so each call hands back
+    # its output instead of printing it; this keeps the output from
+    # different targets from getting interleaved.
+    clr = pcommand.clr()
+
+    def _get(target: str) -> str:
+        return get_target(target, batch=True, clr=clr)
+
+    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+        # Note: consuming results in order also re-raises any errors.
+        for output in executor.map(_get, sorted(needed_targets)):
+            if output:
+                print(output)
 
 
 def win_ci_binary_build() -> None:
@@ -257,8 +347,10 @@ def win_ci_binary_build() -> None:
 
 def update_cmake_prefab_lib() -> None:
     """Update prefab internal libs for builds."""
+    # pylint: disable=too-many-locals
     import subprocess
     import os
+    import shutil
     from efro.error import CleanError
     import batools.build
 
@@ -298,12 +390,13 @@ def update_cmake_prefab_lib() -> None:
     if update:
         if not os.path.exists(libdir):
             os.makedirs(libdir, exist_ok=True)
-        subprocess.run(['cp', target, libdir], check=True)
+        shutil.copy2(target, libpath)
 
 
 def android_archive_unstripped_libs() -> None:
     """Copy libs to a build archive."""
-    import subprocess
+    import shutil
+    import tarfile
     from pathlib import Path
     from efro.error import CleanError
     from efro.terminal import Clr
@@ -314,8 +407,10 @@ def android_archive_unstripped_libs() -> None:
         raise CleanError('Expected 2 args; src-dir and dst-dir')
     src = Path(sys.argv[2])
     dst = Path(sys.argv[3])
-    if dst.exists():
-        subprocess.run(['rm', '-rf', dst], check=True)
+    if dst.is_dir() and not dst.is_symlink():
+        shutil.rmtree(dst)
+    elif dst.exists() or dst.is_symlink():
+        dst.unlink()
     dst.mkdir(parents=True, exist_ok=True)
     if not src.is_dir():
         raise CleanError(f"Source dir not found: '{src}'")
@@ -329,14 +424,12 @@ def android_archive_unstripped_libs() -> None:
     ]:
         srcpath = Path(src, abi, libname + libext)
         dstname = f'{libname}_{abishort}{libext}'
-        dstpath = Path(dst, dstname)
         if srcpath.exists():
             print(f'Archiving unstripped library: {Clr.BLD}{dstname}{Clr.RST}')
-            subprocess.run(['cp', srcpath, dstpath], check=True)
-            subprocess.run(
-                ['tar', '-zcf', dstname + '.tgz', dstname], cwd=dst, check=True
-            )
-            subprocess.run(['rm', dstpath], check=True)
+            # Archive the lib straight from its source location under
+            # its archived name; no need to stage a copy in dst first.
+            with tarfile.open(Path(dst, dstname + '.tgz'), 'w:gz') as archive:
+                archive.add(srcpath, arcname=dstname)
 
 
 def spinoff_test() -> None:
@@ -388,6 +481,11 @@ def gen_python_init_module() -> None:
         projroot=str(pcommand.PROJROOT), path=outfilename
     )
     print(f'Meta-building {Clr.BLD}{prettypath}{Clr.RST}')
+
+    # Note: we always write here (rather than _write_if_changed) since
+    # our output never changes; skipping the write would leave the file
+    # perpetually older than its Makefile prereqs and we'd rerun on
+    # every build.
     with open(outfilename, 'w', encoding='utf-8') as outfile:
         outfile.write(
             '# Released under the MIT License.'
@@ -416,20 +514,15 @@ def tests_warm_start() -> None:
 def wsl_build_check_win_drive() -> None:
     """Make sure we're building on a windows drive."""
     import os
+    import shutil
     import subprocess
-    import textwrap
     from efro.error import CleanError
 
     # We use env vars to influence our behavior and thus can't support
     # batch.
     pcommand.disallow_in_batch()
 
-    if (
-        subprocess.run(
-            ['which', 'wslpath'], check=False, capture_output=True
-        ).returncode
-        != 0
-    ):
+    if shutil.which('wslpath') is None:
         raise CleanError(
             'wslpath not found; you must run this from a WSL environment'
         )
@@ -438,21 +531,20 @@ def wsl_build_check_win_drive() -> None:
         return
 
     # Get a windows path to the current dir.
-    path = (
-        subprocess.run(
-            ['wslpath', '-w', '-a', os.getcwd()],
-            capture_output=True,
-            check=True,
-        )
-        .stdout.decode()
-        .strip()
-    )
+    path = subprocess.run(
+        ['wslpath', '-w', '-a', os.getcwd()],
+        capture_output=True,
+        check=True,
+        encoding='utf-8',
+    ).stdout.strip()
 
     # If we're sitting under the linux filesystem, our path
     # will start with \\wsl$; fail in that case and explain why.
     if not path.startswith('\\\\wsl$'):
         return
 
+    import textwrap
+
     def _wrap(txt: str) -> str:
         return textwrap.fill(txt, 76)
 
@@ -491,7 +583,6 @@ def wsl_build_check_win_drive() -> None:
 def wsl_path_to_win() -> None:
     """Forward escape slashes in a provided win path arg."""
     import subprocess
-    import logging
     import os
     from efro.error import CleanError
 
@@ -522,21 +613,29 @@ def wsl_path_to_win() -> None:
             raise CleanError(f'Path \'{wsl_path}\' does not exist.')
 
         results = subprocess.run(
-            ['wslpath', '-w', '-a', wsl_path], capture_output=True, check=True
+            ['wslpath', '-w', '-a', wsl_path],
+            capture_output=True,
+            check=True,
+            encoding='utf-8',
         )
     except Exception:
+        import logging
+
         # This gets used in a makefile so our returncode is ignored;
         # let's try to make our failure known in other ways.
         logging.exception('wsl_to_escaped_win_path failed.')
         print('wsl_to_escaped_win_path_error_occurred', end='')
         return
 
-    out = results.stdout.decode().strip()
+    out = results.stdout.strip()
 
     # If our input ended with a slash, match in the output.
     if wsl_path.endswith('/') and not out.endswith('\\'):
         out += '\\'
 
+    # Note: plain str.replace() is the quickest way to do this for a
+    # single char; str.translate() measures around an order of magnitude
+    # slower on typical paths.
     if escape:
         out = out.replace('\\', '\\\\')
     print(out, end='')